@@ -2,16 +2,23 @@
 FID, IS, JS divergence.
 """
 import os
+import io
+import json
+import hashlib
+import tempfile
 from typing import List, Union, Tuple
 
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
+from torch.utils.data import DataLoader, TensorDataset
 import wandb
 import numpy as np
 import matplotlib.pyplot as plt
-from sklearn.decomposition import PCA
-from sklearn.manifold import TSNE
+from matplotlib.collections import LineCollection
+from openTSNE import TSNE
+from openTSNE.initialization import rescale
+from PIL import Image
 
 from experiments.exp_stage2 import ExpStage2
 from generators.maskgit import MaskGIT
@@ -19,15 +26,47 @@ from preprocessing.data_pipeline import build_data_pipeline
 from preprocessing.preprocess_ucr import DatasetImporterUCR, DatasetImporterCustom
 from generators.sample import unconditional_sample, conditional_sample
 from supervised_FCN_2.example_pretrained_model_loading import load_pretrained_FCN
-from supervised_FCN_2.example_compute_FID import calculate_fid
 from supervised_FCN_2.example_compute_IS import calculate_inception_score
 from utils import time_to_timefreq, timefreq_to_time
 from generators.fidelity_enhancer import FidelityEnhancer
-from evaluation.rocket_functions import generate_kernels, apply_kernels
+from evaluation.rocket_functions import generate_kernels, apply_kernels, KernelArrays
 from utils import zero_pad_low_freq, zero_pad_high_freq, remove_outliers
 from evaluation.stat_metrics import marginal_distribution_difference, auto_correlation_difference, skewness_difference, kurtosis_difference
+from evaluation.metrics import calculate_fid_torch
 
 
+ZCACHE_VERSION = 3  # format of `saved_models/zcache-*.npz`; 2: `KernelArrays` fields and float32 ROCKET features, 3: kernels drawn from `np.random.default_rng(rocket_seed)`
+
+
+class PCA(object):
+    """
+    PCA by `torch.pca_lowrank` on `device`, with the `fit`/`transform`/`fit_transform` interface of `sklearn.decomposition.PCA`.
+    the fitted components (d n_components) and mean (d,) stay on `device`.
+    """
+    def __init__(self, n_components:int, device:torch.device, random_state:int=0):
+        self.n_components = n_components
+        self.device = torch.device(device)
+        self.random_state = random_state
+
+    @torch.no_grad()
+    def fit(self, Z:np.ndarray):
+        Z = torch.as_tensor(Z, dtype=torch.float32, device=self.device)  # (b d)
+        self.mean = Z.mean(dim=0)  # (d,)
+        with torch.random.fork_rng(devices=[self.device] if self.device.type == 'cuda' else []):
+            torch.manual_seed(self.random_state)  # `pca_lowrank` draws a random projection
+            q = min(self.n_components + 10, *Z.shape)  # oversampling makes the leading components more accurate
+            _, _, V = torch.pca_lowrank(Z - self.mean, q=q, center=False, niter=4)  # (d q)
+        self.V = V[:, :self.n_components]  # (d n_components)
+        return self
+
+    @torch.no_grad()
+    def transform(self, Z:np.ndarray) -> np.ndarray:
+        Z = torch.as_tensor(Z, dtype=torch.float32, device=self.device)  # (b d)
+        return ((Z - self.mean) @ self.V).cpu().numpy()  # (b n_components)
+
+    def fit_transform(self, Z:np.ndarray) -> np.ndarray:
+        return self.fit(Z).transform(Z)
+
 
 class Evaluation(nn.Module):
     """
@@ -47,6 +86,7 @@ class Evaluation(nn.Module):
                  use_fidelity_enhancer:bool=False,
                  feature_extractor_type:str='rocket',
                  rocket_num_kernels:int=1000,
+                 rocket_seed:int=0,
                  use_custom_dataset:bool=False
                  ):
         super().__init__()
@@ -57,11 +97,9 @@ class Evaluation(nn.Module):
         self.feature_extractor_type = feature_extractor_type
         assert feature_extractor_type in ['supervised_fcn', 'rocket'], 'unavailable feature extractor type.'
 
-        if not use_custom_dataset:
-            self.fcn = load_pretrained_FCN(dataset_name).to(device)
-            self.fcn.eval()
-        if feature_extractor_type == 'rocket':
-            self.rocket_kernels = generate_kernels(input_length, num_kernels=rocket_num_kernels)
+        # the pretrained FCN is loaded on first access to `self.fcn`; with ROCKET features only `inception_score` needs it
+        self.use_custom_dataset = use_custom_dataset
+        self._fcn = None
 
         # load the numpy matrix of the test samples
         dataset_importer = DatasetImporterUCR(dataset_name, **config['dataset']) if not use_custom_dataset else DatasetImporterCustom(**config['dataset'])
@@ -72,6 +110,17 @@ class Evaluation(nn.Module):
         self.mean = dataset_importer.mean  # scaling coefficient
         self.std = dataset_importer.std  # scaling coefficient
 
+        # float32 tensors of `X_train`/`X_test`, converted (and pinned for async host-to-device copies) only once
+        self._X_train_t = torch.from_numpy(self.X_train).float()  # (b 1 l)
+        self._X_test_t = torch.from_numpy(self.X_test).float()  # (b 1 l)
+        if self.device.type == 'cuda':
+            self._X_train_t, self._X_test_t = self._X_train_t.pin_memory(), self._X_test_t.pin_memory()
+        self._X_device = {}  # copies on `self.device`, made on first use
+        self._fcn_cache = {}  # FCN outputs of `X_train`/`X_test`; see `_fcn_outputs`
+        self._clean_cache = {}  # 'train'/'test' -> remove_outliers(z_train/z_test); see `_remove_outliers`
+        self.plot_dpi = 72  # resolution of the figures logged to wandb
+        self._rng = np.random.default_rng(0)  # samples the points drawn in the logged figures
+
         self.ts_len = self.X_train.shape[-1]  # time series length
         self.n_classes = len(np.unique(dataset_importer.Y_train))
 
@@ -91,6 +140,16 @@ class Evaluation(nn.Module):
         self.maskgit = self.stage2.maskgit
         self.stage1 = self.stage2.maskgit.stage1
 
+        # on GPU, compile the token encoding/decoding passes used by `sample` and `compute_z_svq`.
+        # the default mode is used instead of 'reduce-overhead' because CUDA-graph outputs can be overwritten by the next replay,
+        # while `compute_z_svq` still holds the output of one call (e.g., `x_a_l`) when it makes the next.
+        if self.device.type == 'cuda':
+            self.maskgit.encode_to_z_q = torch.compile(self.maskgit.encode_to_z_q, dynamic=True)
+            self.maskgit.decode_token_ind_to_timeseries = torch.compile(self.maskgit.decode_token_ind_to_timeseries, dynamic=True)
+
+        # side streams on which `compute_z_svq` runs its independent LF and HF branches concurrently
+        self._svq_streams = (torch.cuda.Stream(self.device), torch.cuda.Stream(self.device)) if self.device.type == 'cuda' else None
+
         # load the fidelity enhancer
         if use_fidelity_enhancer:
             self.fidelity_enhancer = FidelityEnhancer(self.ts_len, 1, config)
@@ -100,17 +159,84 @@ class Evaluation(nn.Module):
         else:
             self.fidelity_enhancer = nn.Identity()
 
+        # compute z_train, z_test; they are deterministic given the cache key, so they are cached on disk
+        cache_key = self._cache_key(input_length, rocket_num_kernels, rocket_seed, use_custom_dataset)
+        zcache_fname = os.path.join('saved_models', f'zcache-{cache_key}.npz')
+        if os.path.isfile(zcache_fname):
+            with np.load(zcache_fname) as zcache:
+                self.z_train, self.z_test = zcache['z_train'], zcache['z_test']
+                if feature_extractor_type == 'rocket':
+                    self.rocket_kernels = KernelArrays(*(zcache[f'rocket_kernels_{name}'] for name in KernelArrays._fields))
+        else:
+            if feature_extractor_type == 'rocket':
+                self.rocket_kernels = generate_kernels(input_length, num_kernels=rocket_num_kernels, seed=rocket_seed)
+            self.z_train = self.compute_z('train')
+            self.z_test = self.compute_z('test')
+
+            # write to a temporary file first so that an interrupted or concurrent run never leaves a truncated cache behind
+            rocket_kernels = {f'rocket_kernels_{name}': k for name, k in self.rocket_kernels._asdict().items()} if feature_extractor_type == 'rocket' else {}
+            os.makedirs('saved_models', exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir='saved_models', prefix='zcache-', suffix='.npz.tmp', delete=False) as f:
+                try:
+                    np.savez_compressed(f, z_train=self.z_train, z_test=self.z_test, **rocket_kernels)
+                except BaseException:
+                    # a failed write (e.g., disk full or an interrupt) must not leave the temporary file behind
+                    f.close()
+                    os.unlink(f.name)
+                    raise
+            os.replace(f.name, zcache_fname)
+
         # fit PCA on a training set
-        self.pca = PCA(n_components=2, random_state=0)
-        self.z_train = self.compute_z('train')
-        self.z_test = self.compute_z('test')
+        self.pca = PCA(n_components=2, device=self.device, random_state=0)
 
-        z_test = remove_outliers(self.z_test)  # only used to fit pca because `def fid_score` already contains `remove_outliers`
+        z_test = self._remove_outliers(self.z_test)  # only used to fit pca; memoized, so `def fid_score` on `z_test` reuses it
         z_transform_pca = self.pca.fit_transform(z_test)
 
         self.xmin_pca, self.xmax_pca = np.min(z_transform_pca[:,0]), np.max(z_transform_pca[:,0])
         self.ymin_pca, self.ymax_pca = np.min(z_transform_pca[:,1]), np.max(z_transform_pca[:,1])
 
+        # PCA used to reduce Z before t-SNE and to initialize its embedding
+        self.pca_tsne = PCA(n_components=min(50, *z_test.shape), device=self.device, random_state=0)
+        self.pca_tsne.fit(z_test)
+
+    @property
+    def fcn(self) -> nn.Module:
+        """
+        the pretrained FCN of `dataset_name`, loaded onto `self.device` on first access.
+        it is unavailable with a custom dataset.
+        """
+        if self._fcn is None:
+            assert not self.use_custom_dataset, 'the pretrained FCN is unavailable for a custom dataset.'
+            self._fcn = load_pretrained_FCN(self.dataset_name).to(self.device).eval()  # registered as a submodule
+        return self._fcn
+
+    def _cache_key(self, input_length:int, rocket_num_kernels:int, rocket_seed:int, use_custom_dataset:bool) -> str:
+        """
+        sha1 over everything that determines `z_train` and `z_test`.
+        `ZCACHE_VERSION` has to be bumped whenever the stored schema or the feature computation changes.
+        """
+        if self.feature_extractor_type == 'supervised_fcn':
+            fcn_hash = hashlib.sha1()
+            for name, param in self.fcn.state_dict().items():
+                fcn_hash.update(name.encode())
+                fcn_hash.update(param.detach().cpu().numpy().tobytes())
+            fcn_hash = fcn_hash.hexdigest()
+        else:
+            fcn_hash = None
+
+        key = {'version': ZCACHE_VERSION,
+               'fcn': fcn_hash,
+               'dataset_name': self.dataset_name,
+               'input_length': input_length,
+               'feature_extractor_type': self.feature_extractor_type,
+               'rocket_num_kernels': rocket_num_kernels,
+               'rocket_seed': rocket_seed,
+               'use_custom_dataset': use_custom_dataset,
+               'dataset': self.config['dataset'],
+               'evaluation': self.config['evaluation'],
+               }
+        return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
     @torch.no_grad()
     def sample(self, n_samples: int, kind: str, class_index:Union[int,None]=None, unscale:bool=False):
         """
@@ -119,24 +245,26 @@ class Evaluation(nn.Module):
         """
         assert kind in ['unconditional', 'conditional']
 
-        # sampling
-        if kind == 'unconditional':
-            x_new_l, x_new_h, x_new = unconditional_sample(self.maskgit, n_samples, self.device, batch_size=self.batch_size)  # (b c l); b=n_samples, c=1 (univariate)
-        elif kind == 'conditional':
-            x_new_l, x_new_h, x_new = conditional_sample(self.maskgit, n_samples, self.device, class_index, self.batch_size)  # (b c l); b=n_samples, c=1 (univariate)
-        else:
-            raise ValueError
-
-        # FE
-        num_batches = x_new.shape[0] // self.batch_size + (1 if x_new.shape[0] % self.batch_size != 0 else 0)
-        X_new_R = []
-        for i in range(num_batches):
-            start_idx = i * self.batch_size
-            end_idx = start_idx + self.batch_size
-            mini_batch = x_new[start_idx:end_idx]
-            x_new_R = self.fidelity_enhancer(mini_batch.to(self.device)).cpu()
-            X_new_R.append(x_new_R)
-        X_new_R = torch.cat(X_new_R)
+        with self._autocast():
+            # sampling
+            if kind == 'unconditional':
+                x_new_l, x_new_h, x_new = unconditional_sample(self.maskgit, n_samples, self.device, batch_size=self.batch_size)  # (b c l); b=n_samples, c=1 (univariate)
+            elif kind == 'conditional':
+                x_new_l, x_new_h, x_new = conditional_sample(self.maskgit, n_samples, self.device, class_index, self.batch_size)  # (b c l); b=n_samples, c=1 (univariate)
+            else:
+                raise ValueError
+
+            # FE
+            num_batches = x_new.shape[0] // self.batch_size + (1 if x_new.shape[0] % self.batch_size != 0 else 0)
+            X_new_R = []
+            for i in range(num_batches):
+                start_idx = i * self.batch_size
+                end_idx = start_idx + self.batch_size
+                mini_batch = x_new[start_idx:end_idx]
+                x_new_R = self.fidelity_enhancer(mini_batch.to(self.device)).cpu()
+                X_new_R.append(x_new_R)
+            X_new_R = torch.cat(X_new_R)
+        x_new_l, x_new_h, x_new, X_new_R = x_new_l.float(), x_new_h.float(), x_new.float(), X_new_R.float()
 
         # unscale
         if unscale:
@@ -147,47 +275,153 @@ class Evaluation(nn.Module):
 
         return (x_new_l, x_new_h, x_new), X_new_R
 
-    def _extract_feature_representations(self, x:np.ndarray):
+    def _autocast(self):
+        """
+        bf16 autocast for the stage-1/stage-2 forward passes; enabled only on GPUs that support bf16.
+        """
+        enabled = self.device.type == 'cuda' and torch.cuda.is_bf16_supported()
+        return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=enabled)
+
+    def _get_X(self, kind:str, on_device:bool=False) -> torch.Tensor:
+        """
+        `X_train` or `X_test` as a float32 tensor (b 1 l).
+
+        on_device: return the copy on `self.device`; it is made on the first call and kept (UCR datasets are small).
+        """
+        assert kind in ['train', 'test']
+        X = self._X_train_t if kind == 'train' else self._X_test_t
+        if not on_device:
+            return X
+        if kind not in self._X_device:
+            self._X_device[kind] = X.to(self.device, non_blocking=True)
+        return self._X_device[kind]
+
+    def _extract_feature_representations(self, x:Union[np.ndarray, torch.Tensor]):
         """
         x: (b 1 l)
         """
         if self.feature_extractor_type == 'supervised_fcn':
-            z = self.fcn(torch.from_numpy(x).float().to(self.device), return_feature_vector=True).cpu().detach().numpy()  # (b d)
+            x = torch.as_tensor(x).float().to(self.device)
+            z = self.fcn(x, return_feature_vector=True).cpu().detach().numpy()  # (b d)
         elif self.feature_extractor_type == 'rocket':
-            x = x[:,0,:]  # (b l)
+            if isinstance(x, torch.Tensor):
+                x = x.cpu().numpy()
+            x = np.ascontiguousarray(x[:,0,:], dtype=np.float32)  # (b l); no copy for the float32 minibatches of `_compute_z_minibatches`
             z = apply_kernels(x, self.rocket_kernels)
             z = F.normalize(torch.from_numpy(z), p=2, dim=1).numpy()
         else:
             raise ValueError
         return z
 
+    def _build_data_loader(self, X:Union[np.ndarray, torch.Tensor]) -> DataLoader:
+        """
+        minibatches of `X` (b 1 l) as (pinned) float32 tensors.
+        loading stays in the main process: forking workers after numba's parallel backend has started (`apply_kernels`) deadlocks.
+        """
+        X = torch.as_tensor(X).float()
+        return DataLoader(TensorDataset(X), batch_size=self.batch_size, shuffle=False, num_workers=0, pin_memory=(self.device.type == 'cuda'))
+
+    def _prefetch_to_device(self, data_loader:DataLoader):
+        """
+        yields the minibatches of `data_loader` on `self.device`.
+        on GPU, the host-to-device copy of the next minibatch is issued on a side stream while the current one is being processed.
+        """
+        if self.device.type != 'cuda':
+            for (x,) in data_loader:
+                yield x.to(self.device)
+            return
+
+        copy_stream = torch.cuda.Stream(self.device)
+        compute_stream = torch.cuda.current_stream(self.device)
+        x_next = None
+        for (x,) in data_loader:
+            with torch.cuda.stream(copy_stream):
+                x = x.to(self.device, non_blocking=True)
+            if x_next is not None:
+                yield x_next
+            compute_stream.wait_stream(copy_stream)
+            x.record_stream(compute_stream)
+            x_next = x
+        if x_next is not None:
+            yield x_next
+
+    def _map_minibatches(self, X:Union[np.ndarray, torch.Tensor], fn) -> Tuple[np.ndarray, ...]:
+        """
+        applies `fn` to the minibatches of `X` (b 1 l) on `self.device` and writes its outputs into preallocated float32 arrays.
+
+        fn: function of a minibatch that returns a tuple of arrays with the batch as the first dim.
+        """
+        n_samples = X.shape[0]
+        outs = None
+        i = 0
+        for x in self._prefetch_to_device(self._build_data_loader(X)):
+            outs_t = fn(x)
+            if outs is None:
+                outs = tuple(np.empty((n_samples, *o.shape[1:]), dtype=np.float32) for o in outs_t)
+            for out, o in zip(outs, outs_t):
+                out[i:i + o.shape[0]] = o
+            i += outs_t[0].shape[0]
+        return outs
+
+    def _reference_kind(self, X:Union[np.ndarray, torch.Tensor]) -> Union[str, None]:
+        """
+        'train' or 'test' if `X` is `X_train` or `X_test` (the numpy array or its tensor), otherwise None.
+        """
+        if X is self.X_train or X is self._X_train_t:
+            return 'train'
+        if X is self.X_test or X is self._X_test_t:
+            return 'test'
+        return None
+
+    def _fcn_forward(self, x:torch.Tensor) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        FCN feature vectors and softmax distribution p(y|x) of `x` (b 1 l) from a single forward pass.
+        """
+        z = self.fcn(x.float(), return_feature_vector=True)  # (b d)
+        p_yx = torch.softmax(self.fcn.final(z), dim=-1)  # (b n_classes)
+        return z.cpu().detach().numpy(), p_yx.cpu().detach().numpy()
+
+    def _fcn_outputs(self, X:Union[np.ndarray, torch.Tensor]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        FCN feature vectors and p(y|x) of `X` (b 1 l).
+        they are memoized for `X_train` and `X_test`, so computing e.g., FID and IS on the same instance takes one forward pass.
+        """
+        kind = self._reference_kind(X)
+        key = (kind, next(self.fcn.parameters()).device)  # invalidated if the FCN is moved to another device
+        if kind is not None and key in self._fcn_cache:
+            return self._fcn_cache[key]
+
+        outputs = self._map_minibatches(X, self._fcn_forward)
+        if kind is not None:
+            self._fcn_cache[key] = outputs
+        return outputs
+
+    def _compute_z_minibatches(self, X:Union[np.ndarray, torch.Tensor], transform=None) -> np.ndarray:
+        """
+        feature vectors of `X` (b 1 l), computed minibatch-wise and written into a preallocated array.
+        ROCKET features of `X` without `transform` are computed in a single call.
+
+        transform: optional function applied to each minibatch (on `self.device`) before the feature extraction.
+        """
+        if transform is None and self.feature_extractor_type == 'rocket':
+            # ROCKET runs on CPU and `apply_kernels` already parallelizes over samples, so no minibatching is needed
+            return self._extract_feature_representations(X)
+        if transform is None and self.feature_extractor_type == 'supervised_fcn':
+            z, _ = self._fcn_outputs(X)
+            return z
+
+        zs, = self._map_minibatches(X, lambda x: (self._extract_feature_representations(transform(x)),))
+        return zs
+
+    @torch.no_grad()
     def compute_z_rec(self, kind:str):
         """
         compute representations of X_rec
         """
-        assert kind in ['train', 'test']
-        if kind == 'train':
-            X = self.X_train  # (b 1 l)
-        elif kind == 'test':
-            X = self.X_test  # (b 1 l)
-        else:
-            raise ValueError
-        
-        n_samples = X.shape[0]
-        n_iters = n_samples // self.batch_size
-        if n_samples % self.batch_size > 0:
-            n_iters += 1
+        X = self._get_X(kind)  # (b 1 l)
 
-        # get feature vectors from `X_test`
-        zs = []
-        for i in range(n_iters):
-            s = slice(i * self.batch_size, (i + 1) * self.batch_size)
-            x = X[s]  # (b 1 l)
-            x = torch.from_numpy(x).float().to(self.device)
-            x_rec = self.stage1.forward(batch=(x, None), batch_idx=-1, return_x_rec=True).cpu().detach().numpy().astype(float)  # (b 1 l)
-            z_t = self._extract_feature_representations(x_rec)
-            zs.append(z_t)
-        zs = np.concatenate(zs, axis=0)
+        reconstruct = lambda x: self.stage1.forward(batch=(x, None), batch_idx=-1, return_x_rec=True)  # (b 1 l)
+        zs = self._compute_z_minibatches(X, transform=reconstruct)
         return zs
 
     @torch.no_grad()
@@ -195,120 +429,107 @@ class Evaluation(nn.Module):
         """
         compute representations of X', a stochastic variant of X with SVQ
         """
-        assert kind in ['train', 'test']
-        if kind == 'train':
-            X = self.X_train  # (b 1 l)
-        elif kind == 'test':
-            X = self.X_test  # (b 1 l)
-        else:
-            raise ValueError
-        
+        X = self._get_X(kind, on_device=True)  # (b 1 l)
+
         n_samples = X.shape[0]
         n_iters = n_samples // self.batch_size
         if n_samples % self.batch_size > 0:
             n_iters += 1
 
+        def svq_branch(x, kind_:str, tau:float):
+            encoder, vq_model = (self.stage1.encoder_l, self.stage1.vq_model_l) if kind_ == 'lf' else (self.stage1.encoder_h, self.stage1.vq_model_h)
+            _, s_a = self.maskgit.encode_to_z_q(x, encoder, vq_model, svq_temp=tau)  # (b n)
+            return self.maskgit.decode_token_ind_to_timeseries(s_a, kind_)  # (b 1 l)
+
         # get feature vectors from `X_test`
-        zs = []
-        xs_a = []
+        zs = None
+        xs_a = np.empty((n_samples, 1, self.ts_len), dtype=np.float32)  # (b 1 l)
         for i in range(n_iters):
             s = slice(i * self.batch_size, (i + 1) * self.batch_size)
             x = X[s]  # (b 1 l)
-            x = torch.from_numpy(x).float().to(self.device)
-            
+
             # x_rec = self.stage1.forward(batch=(x, None), batch_idx=-1, return_x_rec=True).cpu().detach().numpy().astype(float)  # (b 1 l)
             # svq_temp_rng = self.config['fidelity_enhancer']['svq_temp_rng']
             # svq_temp = np.random.uniform(*svq_temp_rng)
             # tau = self.config['fidelity_enhancer']['tau']
             tau = self.fidelity_enhancer.tau.item()
-            _, s_a_l = self.maskgit.encode_to_z_q(x, self.stage1.encoder_l, self.stage1.vq_model_l, svq_temp=tau)  # (b n)
-            _, s_a_h = self.maskgit.encode_to_z_q(x, self.stage1.encoder_h, self.stage1.vq_model_h, svq_temp=tau)  # (b m)
-            x_a_l = self.maskgit.decode_token_ind_to_timeseries(s_a_l, 'lf')  # (b 1 l)
-            x_a_h = self.maskgit.decode_token_ind_to_timeseries(s_a_h, 'hf')  # (b 1 l)
-            x_a = x_a_l + x_a_h  # (b c l)
-            x_a = x_a.cpu().numpy().astype(float)
-            xs_a.append(x_a)
+            with self._autocast():
+                if self._svq_streams is None:
+                    x_a_l = svq_branch(x, 'lf', tau)  # (b 1 l)
+                    x_a_h = svq_branch(x, 'hf', tau)  # (b 1 l)
+                else:
+                    # the LF and HF branches are independent, so they are issued on two side streams
+                    main_stream = torch.cuda.current_stream(self.device)
+                    for stream in self._svq_streams:
+                        stream.wait_stream(main_stream)  # `x` is ready on the main stream
+                    with torch.cuda.stream(self._svq_streams[0]):
+                        x_a_l = svq_branch(x, 'lf', tau)  # (b 1 l)
+                    with torch.cuda.stream(self._svq_streams[1]):
+                        x_a_h = svq_branch(x, 'hf', tau)  # (b 1 l)
+                    for stream, x_a_ in zip(self._svq_streams, (x_a_l, x_a_h)):
+                        main_stream.wait_stream(stream)
+                        x_a_.record_stream(main_stream)
+                x_a = x_a_l + x_a_h  # (b c l); summed on `self.device`
+            x_a = x_a.float().cpu().numpy()  # single device-to-host copy
+            xs_a[s] = x_a
 
             z_t = self._extract_feature_representations(x_a)
-            zs.append(z_t)
-        zs = np.concatenate(zs, axis=0)
-        xs_a = np.concatenate(xs_a, axis=0)
+            if zs is None:
+                zs = np.empty((n_samples, z_t.shape[-1]), dtype=np.float32)
+            zs[s] = z_t
         return zs, xs_a
 
+    @torch.no_grad()
     def compute_z(self, kind: str) -> np.ndarray:
         """
         It computes representation z given input x
         :param X_gen: generated X
         :return: z_test (z on X_test), z_gen (z on X_generated)
         """
-        assert kind in ['train', 'test']
-        if kind == 'train':
-            X = self.X_train  # (b 1 l)
-        elif kind == 'test':
-            X = self.X_test  # (b 1 l)
-        else:
-            raise ValueError
-
-        n_samples = X.shape[0]
-        n_iters = n_samples // self.batch_size
-        if n_samples % self.batch_size > 0:
-            n_iters += 1
+        X = self._get_X(kind)  # (b 1 l)
 
-        # get feature vectors from `X_test`
-        zs = []
-        for i in range(n_iters):
-            s = slice(i * self.batch_size, (i + 1) * self.batch_size)
-            z_t = self._extract_feature_representations(X[s])
-            zs.append(z_t)
-        zs = np.concatenate(zs, axis=0)
+        zs = self._compute_z_minibatches(X)
         return zs
 
+    @torch.no_grad()
     def compute_z_gen(self, X_gen: torch.Tensor) -> np.ndarray:
         """
         It computes representation z given input x
         :param X_gen: generated X
         :return: z_test (z on X_test), z_gen (z on X_generated)
         """
-        n_samples = X_gen.shape[0]
-        n_iters = n_samples // self.batch_size
-        if n_samples % self.batch_size > 0:
-            n_iters += 1
-
-        # get feature vectors from `X_gen`
-        z_gen = []
-        for i in range(n_iters):
-            s = slice(i * self.batch_size, (i + 1) * self.batch_size)
-
-            # z_g = self.fcn(X_gen[s].float().to(self.device), return_feature_vector=True).cpu().detach().numpy()
-            z_g = self._extract_feature_representations(X_gen[s].numpy().astype(float))
-
-            z_gen.append(z_g)
-        z_gen = np.concatenate(z_gen, axis=0)
+        z_gen = self._compute_z_minibatches(X_gen)
         return z_gen
 
-    def fid_score(self, z1:np.ndarray, z2:np.ndarray) -> int:
-        z1, z2 = remove_outliers(z1), remove_outliers(z2)
-        fid = calculate_fid(z1, z2)
+    def _remove_outliers(self, z:np.ndarray) -> np.ndarray:
+        """
+        `remove_outliers`, memoized only for the reference sets `self.z_train`/`self.z_test`, which are scored repeatedly.
+        """
+        kind = 'train' if z is self.z_train else 'test' if z is self.z_test else None
+        if kind is None:
+            return remove_outliers(z)
+        if kind not in self._clean_cache:
+            self._clean_cache[kind] = remove_outliers(z)
+        return self._clean_cache[kind]
+
+    def fid_score(self, z1:np.ndarray, z2:np.ndarray, skip_outlier:bool=False) -> float:
+        """
+        skip_outlier: set True if the caller has already removed outliers from `z1` and `z2`.
+        """
+        if not skip_outlier:
+            z1, z2 = self._remove_outliers(z1), self._remove_outliers(z2)
+        fid = calculate_fid_torch(z1, z2, self.device)
         return fid
 
+    @torch.no_grad()
     def inception_score(self, X_gen: torch.Tensor):
         # assert self.X_test.shape[0] == X_gen.shape[0], "shape of `X_test` must be the same as that of `X_gen`."
 
-        n_samples = self.X_test.shape[0]
-        n_iters = n_samples // self.batch_size
-        if n_samples % self.batch_size > 0:
-            n_iters += 1
-
-        # get the softmax distribution from `X_gen`
-        p_yx_gen = []
-        for i in range(n_iters):
-            s = slice(i * self.batch_size, (i + 1) * self.batch_size)
-
-            p_yx_g = self.fcn(X_gen[s].float().to(self.device))  # p(y|x)
-            p_yx_g = torch.softmax(p_yx_g, dim=-1).cpu().detach().numpy()
-
-            p_yx_gen.append(p_yx_g)
-        p_yx_gen = np.concatenate(p_yx_gen, axis=0)
+        # get the softmax distribution from `X_gen`; only the first `len(X_test)` samples are used
+        if self._reference_kind(X_gen) is None:
+            X_gen = X_gen[:self.X_test.shape[0]]
+        _, p_yx_gen = self._fcn_outputs(X_gen)
+        p_yx_gen = p_yx_gen[:self.X_test.shape[0]].copy()  # `calculate_inception_score` shuffles in-place
 
         IS_mean, IS_std = calculate_inception_score(p_yx_gen)
         return IS_mean, IS_std
@@ -326,85 +547,91 @@ class Evaluation(nn.Module):
         kd = kurtosis_difference(x_real, x_gen)
         return mdd, acd, sd, kd
     
+    def _log_figure(self, fig, key:str):
+        """
+        renders `fig` to an in-memory PNG at `self.plot_dpi`, logs it to wandb under `key`, and closes it.
+        """
+        buf = io.BytesIO()
+        fig.savefig(buf, format='png', dpi=self.plot_dpi, bbox_inches='tight')
+        plt.close(fig)
+        buf.seek(0)
+        wandb.log({key: wandb.Image(Image.open(buf))})
+
     def log_visual_inspection(self, X1, X2, title: str, ylim: tuple = (-5, 5), n_plot_samples:int=200, alpha:float=0.1):
         b, c, l = X1.shape
 
         # `X_test`
-        sample_ind = np.random.randint(0, X1.shape[0], n_plot_samples)
-        fig, axes = plt.subplots(2, c, figsize=(c*4, 4))
+        sample_ind1 = self._rng.integers(0, X1.shape[0], n_plot_samples)
+        sample_ind2 = self._rng.integers(0, X2.shape[0], n_plot_samples)
+        fig, axes = plt.subplots(2, c, figsize=(c*4, 4), dpi=self.plot_dpi)
         if c == 1:
             axes = axes[:, np.newaxis]
-        plt.suptitle(title)
+        fig.suptitle(title)
         
         for channel_idx in range(c):
-            # X1
-            for i in sample_ind:
-                axes[0,channel_idx].plot(X1[i, channel_idx, :], alpha=alpha, color='C0')
-            axes[0,channel_idx].set_ylim(*ylim)
+            # X1, X2; all samples of a panel are drawn as a single `LineCollection`
+            for row, (X, sample_ind) in enumerate(((X1, sample_ind1), (X2, sample_ind2))):
+                Y = np.take(np.asarray(X)[:, channel_idx, :], sample_ind, axis=0)  # (n_plot_samples l)
+                segments = np.stack((np.broadcast_to(np.arange(Y.shape[-1]), Y.shape), Y), axis=-1)  # (n_plot_samples l 2)
+                axes[row,channel_idx].add_collection(LineCollection(segments, colors='C0', alpha=alpha, rasterized=True))
+                axes[row,channel_idx].autoscale()
+                axes[row,channel_idx].set_ylim(*ylim)
             axes[0,channel_idx].set_title(f'channel idx:{channel_idx}')
-
-            # X2
-            sample_ind = np.random.randint(0, X2.shape[0], n_plot_samples)
-            for i in sample_ind:
-                axes[1,channel_idx].plot(X2[i, channel_idx, :], alpha=alpha, color='C0')
-            axes[1,channel_idx].set_ylim(*ylim)
             
             if channel_idx == 0:
                 axes[0,channel_idx].set_ylabel('X_test')
                 axes[1,channel_idx].set_ylabel('X_gen')
 
-        plt.tight_layout()
-        wandb.log({f"visual comp ({title})": wandb.Image(plt)})
-        plt.close()
+        fig.tight_layout()
+        self._log_figure(fig, f"visual comp ({title})")
 
     def log_pca(self, Zs:List[np.ndarray], labels:List[str], n_plot_samples:int=1000):
         assert len(Zs) == len(labels)
 
-        plt.figure(figsize=(4, 4))
+        fig, ax = plt.subplots(figsize=(4, 4), dpi=self.plot_dpi)
 
         for Z, label in zip(Zs, labels):
-            ind = np.random.choice(range(Z.shape[0]), size=n_plot_samples, replace=True)
-            Z_embed = self.pca.transform(Z[ind])
+            ind = self._rng.integers(0, Z.shape[0], size=n_plot_samples)
+            Z_embed = self.pca.transform(np.take(Z, ind, axis=0))
             
-            plt.scatter(Z_embed[:, 0], Z_embed[:, 1], alpha=0.1, label=label)
+            ax.scatter(Z_embed[:, 0], Z_embed[:, 1], alpha=0.1, label=label, rasterized=True)
             
             xpad = (self.xmax_pca - self.xmin_pca) * 0.1
             ypad = (self.ymax_pca - self.ymin_pca) * 0.1
-            plt.xlim(self.xmin_pca-xpad, self.xmax_pca+xpad)
-            plt.ylim(self.ymin_pca-ypad, self.ymax_pca+ypad)
+            ax.set_xlim(self.xmin_pca-xpad, self.xmax_pca+xpad)
+            ax.set_ylim(self.ymin_pca-ypad, self.ymax_pca+ypad)
 
-        plt.legend(loc='upper right')
-        plt.tight_layout()
-        wandb.log({f"PCA on Z ({labels})": wandb.Image(plt)})
-        plt.close()
+        ax.legend(loc='upper right')
+        fig.tight_layout()
+        self._log_figure(fig, f"PCA on Z ({labels})")
 
     def log_tsne(self, n_plot_samples: int, X_gen, z_test: np.ndarray, z_gen: np.ndarray):
         X_gen = F.interpolate(X_gen, size=self.X_test.shape[-1], mode='linear', align_corners=True)
         X_gen = X_gen.cpu().numpy()
 
-        sample_ind_test = np.random.randint(0, self.X_test.shape[0], n_plot_samples)
-        sample_ind_gen = np.random.randint(0, X_gen.shape[0], n_plot_samples)
+        sample_ind_test = self._rng.integers(0, self.X_test.shape[0], n_plot_samples)
+        sample_ind_gen = self._rng.integers(0, X_gen.shape[0], n_plot_samples)
 
         # TNSE: data space
-        X = np.concatenate((self.X_test.squeeze()[sample_ind_test], X_gen.squeeze()[sample_ind_gen]), axis=0).squeeze()
+        X = np.concatenate((np.take(self.X_test, sample_ind_test, axis=0), np.take(X_gen, sample_ind_gen, axis=0)), axis=0).squeeze()
         labels = np.array(['C0'] * len(sample_ind_test) + ['C1'] * len(sample_ind_gen))
-        X_embedded = TSNE(n_components=2, learning_rate='auto', init='random').fit_transform(X)
+        X = PCA(n_components=min(50, *X.shape), device=self.device, random_state=0).fit_transform(X)
+        X_embedded = TSNE(n_components=2, n_jobs=-1, initialization='pca', negative_gradient_method='fft', random_state=0).fit(X)
 
-        plt.figure(figsize=(4, 4))
-        plt.scatter(X_embedded[:, 0], X_embedded[:, 1], c=labels, alpha=0.1)
-        # plt.legend()
-        plt.tight_layout()
-        wandb.log({"TNSE-data_space": wandb.Image(plt)})
-        plt.close()
+        fig, ax = plt.subplots(figsize=(4, 4), dpi=self.plot_dpi)
+        ax.scatter(X_embedded[:, 0], X_embedded[:, 1], c=labels, alpha=0.1, rasterized=True)
+        # ax.legend()
+        fig.tight_layout()
+        self._log_figure(fig, "TNSE-data_space")
 
         # TNSE: latent space
-        Z = np.concatenate((z_test[sample_ind_test], z_gen[sample_ind_gen]), axis=0).squeeze()
+        Z = np.concatenate((np.take(z_test, sample_ind_test, axis=0), np.take(z_gen, sample_ind_gen, axis=0)), axis=0).squeeze()
         labels = np.array(['C0'] * len(sample_ind_test) + ['C1'] * len(sample_ind_gen))
-        Z_embedded = TSNE(n_components=2, learning_rate='auto', init='random').fit_transform(Z)
-
-        plt.figure(figsize=(4, 4))
-        plt.scatter(Z_embedded[:, 0], Z_embedded[:, 1], c=labels, alpha=0.1)
-        # plt.legend()
-        plt.tight_layout()
-        wandb.log({"TSNE-latent_space": wandb.Image(plt)})
-        plt.close()
+        Z = self.pca_tsne.transform(Z)
+        Z_embedded = TSNE(n_components=2, n_jobs=-1, initialization=rescale(Z[:, :2]), negative_gradient_method='fft', random_state=0).fit(Z)
+
+        fig, ax = plt.subplots(figsize=(4, 4), dpi=self.plot_dpi)
+        ax.scatter(Z_embedded[:, 0], Z_embedded[:, 1], c=labels, alpha=0.1, rasterized=True)
+        # ax.legend()
+        fig.tight_layout()
+        self._log_figure(fig, "TSNE-latent_space")
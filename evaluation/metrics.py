@@ -9,7 +9,6 @@ import torch.nn.functional as F
 import numpy as np
 
 from supervised_FCN_2.example_pretrained_model_loading import load_pretrained_FCN
-from supervised_FCN_2.example_compute_FID import calculate_fid
 from supervised_FCN_2.example_compute_IS import calculate_inception_score
 from generators.sample import unconditional_sample, conditional_sample
 
@@ -34,6 +33,38 @@ def sample(batch_size:int, maskgit, device, n_samples: int, kind: str, class_ind
     return x_new_l, x_new_h, x_new
 
 
+@torch.no_grad()
+def calculate_fid_torch(z1:np.ndarray, z2:np.ndarray, device:Union[str, torch.device]='cpu') -> float:
+    """
+    torch port of `supervised_FCN_2.example_compute_FID.calculate_fid` that keeps all computation on `device`.
+    tr(sqrtm(sigma1 @ sigma2)) is computed from the eigenvalues of the symmetric PSD matrix sqrt(sigma1) @ sigma2 @ sqrt(sigma1),
+    which has the same spectrum; this stays well-defined when the covariances are singular (e.g., fewer samples than feature dims).
+
+    z1: (b1 d)
+    z2: (b2 d)
+    """
+    z1 = torch.as_tensor(z1, dtype=torch.float64, device=device)
+    z2 = torch.as_tensor(z2, dtype=torch.float64, device=device)
+
+    # calculate mean and covariance statistics
+    mu1, sigma1 = z1.mean(dim=0), torch.cov(z1.T)
+    mu2, sigma2 = z2.mean(dim=0), torch.cov(z2.T)
+
+    # calculate sum squared difference between means
+    ssdiff = ((mu1 - mu2) ** 2).sum()
+
+    # calculate the trace of sqrt of product between cov; negative eigenvalues are round-off and clamped
+    evals, evecs = torch.linalg.eigh(sigma1)
+    sqrt_sigma1 = (evecs * evals.clamp(min=0).sqrt()) @ evecs.T
+    M = sqrt_sigma1 @ sigma2 @ sqrt_sigma1
+    tr_covmean = torch.linalg.eigvalsh((M + M.T) / 2).clamp(min=0).sqrt().sum()
+
+    # calculate score
+    fid = (ssdiff + torch.trace(sigma1) + torch.trace(sigma2) - 2. * tr_covmean).item()
+    assert np.isfinite(fid), 'FID is not finite.'
+    return fid
+
+
 class Metrics(nn.Module):
     """
     - FID
@@ -48,6 +79,7 @@ class Metrics(nn.Module):
                  n_classes:int,
                  feature_extractor_type:str, 
                  rocket_num_kernels:int=1000,
+                 rocket_seed:int=0,
                  batch_size: int=32,
                  use_custom_dataset:bool=False
                  ):
@@ -69,7 +101,7 @@ class Metrics(nn.Module):
             self.fcn.eval()
         elif self.feature_extractor_type == 'rocket':
             input_length = self.X_train.shape[-1]
-            self.rocket_kernels = generate_kernels(input_length, num_kernels=rocket_num_kernels)
+            self.rocket_kernels = generate_kernels(input_length, num_kernels=rocket_num_kernels, seed=rocket_seed)
         else:
             raise ValueError
         
@@ -89,7 +121,7 @@ class Metrics(nn.Module):
             device = next(self.fcn.parameters()).device
             z = self.fcn(torch.from_numpy(x).float().to(device), return_feature_vector=True).cpu().detach().numpy()  # (b d)
         elif self.feature_extractor_type == 'rocket':
-            x = x[:,0,:].astype(float)  # (b l)
+            x = x[:,0,:].astype(np.float32)  # (b l); same precision as the kernels
             z = apply_kernels(x, self.rocket_kernels)  # (b d)
             z = F.normalize(torch.from_numpy(z), p=2, dim=1).numpy()
         else:
@@ -139,9 +171,9 @@ class Metrics(nn.Module):
     #     fid_test_gen = calculate_fid(self.z_test, z_gen)
     #     return fid_train_gen, fid_test_gen
     
-    def fid_score(self, z1:np.ndarray, z2:np.ndarray) -> int:
+    def fid_score(self, z1:np.ndarray, z2:np.ndarray) -> float:
         z1, z2 = remove_outliers(z1), remove_outliers(z2)
-        fid = calculate_fid(z1, z2)
+        fid = calculate_fid_torch(z1, z2)
         return fid
     
     def inception_score(self, x_gen: np.ndarray):
@@ -14,46 +14,54 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
+from functools import lru_cache
+from typing import NamedTuple
 from numba import njit, prange
 import torch.jit as jit
 
 
-@njit("Tuple((float64[:],int32[:],float64[:],int32[:],int32[:]))(int64,int64)")
-def generate_kernels(input_length, num_kernels):
+class KernelArrays(NamedTuple):
+    """
+    ROCKET kernels in a struct-of-arrays layout; the weights of kernel `k` are `weights[offsets[k]:offsets[k+1]]`.
+    """
+    weights: np.ndarray  # float32 (sum(lengths),)
+    lengths: np.ndarray  # int32 (num_kernels,)
+    biases: np.ndarray  # float32 (num_kernels,)
+    dilations: np.ndarray  # int32 (num_kernels,)
+    paddings: np.ndarray  # int32 (num_kernels,)
+    offsets: np.ndarray  # int32 (num_kernels+1,)
 
-    candidate_lengths = np.array((7, 9, 11), dtype = np.int32)
-    lengths = np.random.choice(candidate_lengths, num_kernels)
-
-    weights = np.zeros(lengths.sum(), dtype = np.float64)
-    biases = np.zeros(num_kernels, dtype = np.float64)
-    dilations = np.zeros(num_kernels, dtype = np.int32)
-    paddings = np.zeros(num_kernels, dtype = np.int32)
-
-    a1 = 0
-
-    for i in range(num_kernels):
 
-        _length = lengths[i]
+@lru_cache(maxsize = None)
+def generate_kernels(input_length, num_kernels, seed = 0) -> KernelArrays:
+    """
+    draws the ROCKET kernels from `np.random.default_rng(seed)`, so no global RNG state is used or modified.
+    the result is cached per (input_length, num_kernels, seed) and shared between callers, so its arrays are read-only.
+    """
+    rng = np.random.default_rng(seed)
 
-        _weights = np.random.normal(0, 1, _length)
+    candidate_lengths = np.array((7, 9, 11), dtype = np.int32)
+    lengths = rng.choice(candidate_lengths, num_kernels)
 
-        b1 = a1 + _length
-        weights[a1:b1] = _weights - _weights.mean()
+    offsets = np.zeros(num_kernels + 1, dtype = np.int32)
+    offsets[1:] = np.cumsum(lengths)
 
-        biases[i] = np.random.uniform(-1, 1)
+    # all weights at once; each kernel's weights are then centered on their own mean
+    weights = rng.standard_normal(offsets[-1])
+    weights -= np.repeat(np.add.reduceat(weights, offsets[:-1]) / lengths, lengths)
 
-        dilation = 2 ** np.random.uniform(0, np.log2((input_length - 1) / (_length - 1)))
-        dilation = np.int32(dilation)
-        dilations[i] = dilation
+    biases = rng.uniform(-1, 1, num_kernels)
 
-        padding = ((_length - 1) * dilation) // 2 if np.random.randint(2) == 1 else 0
-        paddings[i] = padding
+    dilations = (2 ** rng.uniform(0, np.log2((input_length - 1) / (lengths - 1)))).astype(np.int32)
 
-        a1 = b1
+    paddings = np.where(rng.integers(0, 2, num_kernels) == 1, ((lengths - 1) * dilations) // 2, 0).astype(np.int32)
 
-    return weights, lengths, biases, dilations, paddings
+    kernels = KernelArrays(weights.astype(np.float32), lengths, biases.astype(np.float32), dilations, paddings, offsets)
+    for k in kernels:
+        k.setflags(write = False)
+    return kernels
 
-@njit(fastmath = True)
+@njit(fastmath = True, cache = True)
 def apply_kernel(X, weights, length, bias, dilation, padding):
 
     input_length = len(X)
@@ -61,7 +69,7 @@ def apply_kernel(X, weights, length, bias, dilation, padding):
     output_length = (input_length + (2 * padding)) - ((length - 1) * dilation)
 
     _ppv = 0
-    _max = np.NINF
+    _max = -np.inf
 
     end = (input_length + padding) - ((length - 1) * dilation)
 
@@ -79,39 +87,31 @@ def apply_kernel(X, weights, length, bias, dilation, padding):
 
             index = index + dilation
 
-        if _sum > _max:
-            _max = _sum
-
-        if _sum > 0:
-            _ppv += 1
+        # branch-free so the compare/accumulate lowers to select + setcc/add
+        _max = max(_max, _sum)
+        _ppv += _sum > 0
 
     return _ppv / output_length, _max
 
-@njit("float64[:,:](float64[:,:],Tuple((float64[::1],int32[:],float64[:],int32[:],int32[:])))", parallel = True, fastmath = True)
+# compiled lazily per input dtype/layout; callers pass a C-contiguous float32 `X` (the precision of the kernels) so that a single specialization is built. returns float32 features.
+@njit(parallel = True, fastmath = True, cache = True)
 def apply_kernels(X, kernels):
 
-    weights, lengths, biases, dilations, paddings = kernels
+    weights, lengths, biases, dilations, paddings, offsets = kernels
 
     num_examples, _ = X.shape
     num_kernels = len(lengths)
 
-    _X = np.zeros((num_examples, num_kernels * 2), dtype = np.float64) # 2 features per kernel
+    _X = np.empty((num_examples, num_kernels * 2), dtype = np.float32) # 2 features per kernel
 
     for i in prange(num_examples):
 
-        a1 = 0 # for weights
-        a2 = 0 # for features
-
-        for j in range(num_kernels):
-
-            b1 = a1 + lengths[j]
-            b2 = a2 + 2
+        _x = X[i]
 
-            _X[i, a2:b2] = \
-            apply_kernel(X[i], weights[a1:b1], lengths[j], biases[j], dilations[j], paddings[j])
+        for k in range(num_kernels):
 
-            a1 = b1
-            a2 = b2
+            _X[i, 2 * k], _X[i, 2 * k + 1] = \
+            apply_kernel(_x, weights[offsets[k]:offsets[k + 1]], lengths[k], biases[k], dilations[k], paddings[k])
 
     return _X
 